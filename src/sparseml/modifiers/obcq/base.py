@@ -15,6 +15,8 @@
 
 from typing import List, Optional, Union
 
+from pydantic import validator
+
 from sparseml.core import Modifier
 from sparseml.core.state import State
 from sparseml.utils import ALL_TOKEN
@@ -40,7 +42,7 @@ class SparseGPTModifier(Modifier):
     :param sequential_update: Whether or not to update weights sequentially by layer,
         True saves on GPU memory
     :param prunen: N for N:M pruning
-    :param prunem: M for N:M pruning
+    :param prunem: M for N:M pruning, block_size must be a multiple of it
     :param targets: list of layer names to compress during OBCQ, or '__ALL__'
         to compress every layer in the model
     :param target_ids: list of keys in model output to cache
@@ -59,5 +61,19 @@ class SparseGPTModifier(Modifier):
     target_ids: Optional[List[str]] = None
     layer_prefix: Optional[str] = None
 
+    @validator("prunem", always=True)
+    def validate_prunem(cls, value, values):
+        # N:M groups are selected relative to the start of each block, so blocks
+        # must split on group boundaries to give a valid N:M mask. Checked here so
+        # a bad config fails before any calibration data is run
+        block_size = values.get("block_size")
+        if values.get("prunen") and block_size is not None:
+            if not value or block_size % value != 0:
+                raise ValueError(
+                    "`block_size` must be a multiple of `prunem` for N:M pruning, "
+                    f"got block_size {block_size} and prunem {value}"
+                )
+        return value
+
     def on_initialize_structure(self, state: "State", **kwargs):
         pass  # nothing needed for this modifier
@@ -17,13 +17,18 @@ import logging
 from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import torch
+from pydantic import validator
 from torch.nn import Module
 
 from sparseml.core.model import ModifiableModel
 from sparseml.core.state import State
 from sparseml.modifiers.obcq.base import SparseGPTModifier
-from sparseml.modifiers.obcq.utils.helpers import cache_attention_inputs
+from sparseml.modifiers.obcq.utils.helpers import (
+    cache_attention_inputs,
+    downcast_calibration_inputs,
+)
 from sparseml.modifiers.obcq.utils.layer_compressor import LayerCompressor
+from sparseml.pytorch.utils import get_floating_point_dtype
 
 
 _LOGGER = logging.getLogger(__name__)
@@ -43,21 +48,36 @@ class SparseGPTModifierPyTorch(SparseGPTModifier):
         - on_finalize
 
     :param model: Pytorch model to perform OBCQ on, in-place
+    :param prefetch_batches: number of calibration batches to copy to the GPU ahead
+        of the one being run through the bottom of the network, 0 to disable
+    :param calib_dtype: name of the floating point torch dtype to store the
+        calibration activations passed between layers in, i.e. bfloat16 for a
+        float32 model. Only applied if it uses fewer bits than the activations.
+        Hessians are still accumulated in float32. Default None keeps the
+        activations in the dtype of the model
     """
 
     model: Any = None
+    prefetch_batches: int = 2
+    calib_dtype: Optional[str] = None
     compressible_layers_: List = None
     device_: str = "cuda:0"
     finalization_kwargs_: Dict = None
+    observers_: List = None
 
-    def compressible_layers(self) -> List[Module]:
+    @validator("calib_dtype")
+    def validate_calib_dtype(cls, value):
+        get_floating_point_dtype(value)
+        return value
+
+    def compressible_layers(self) -> List[Tuple[str, Module]]:
         """
         Retrieves the modules corresponding to a list of compressible layer names
 
-        :return: list of Pytorch modules to compress
+        :return: ordered list of (layer name, Pytorch module) pairs to compress
         """
         compressible_dict = self.model.get_layers(self.targets)
-        return [v for _, v in compressible_dict.items()]
+        return list(compressible_dict.items())
 
     def on_initialize(self, state: "State", **kwargs) -> bool:
         """
@@ -92,7 +112,21 @@ class SparseGPTModifierPyTorch(SparseGPTModifier):
         self.compressible_layers_ = self.compressible_layers()
         self.model = self.model.model
         self._set_device(device)
-
+        # collected once so finalization doesn't walk the full module tree again.
+        # Scripted modules are kept as well, disable_observer also handles scripted
+        # fake quantize modules and skips anything else
+        self.observers_ = [
+            module
+            for module in self.model.modules()
+            if isinstance(
+                module,
+                (torch.quantization.FakeQuantizeBase, torch.jit.RecursiveScriptModule),
+            )
+        ]
+
+    # NOTE: no_grad rather than inference_mode, layers are moved between devices
+    # and their weights rewritten in here. Under inference_mode those parameters
+    # would become inference tensors, breaking any later training on the model
     @torch.no_grad()
     def apply_obcq(
         self, dataloader: Optional[Iterable[Tuple[List, Dict[str, Any]]]] = None
@@ -112,30 +146,42 @@ class SparseGPTModifierPyTorch(SparseGPTModifier):
             dev=self.device_,
             target_ids=self.target_ids,
             layer_prefix=self.layer_prefix,
+            prefetch_batches=self.prefetch_batches,
             **accum_kwargs,
         )
         accum_kwargs.update(extras)
+        calib_dtype = downcast_calibration_inputs(
+            accum_kwargs.get("outputs", []), get_floating_point_dtype(self.calib_dtype)
+        )
+        # calibration activations are not needed for finalization, don't keep them
+        # alive through the returned extras
+        extras.pop("outputs", None)
 
         # Step 1: Sequentially prune/quantize decoder layers
         inputs = None
         num_layers = len(self.compressible_layers_)
-        for idx, layer in enumerate(self.compressible_layers_):
+        args = {
+            "sparsity": self.sparsity,
+            "prunen": self.prunen,
+            "prunem": self.prunem,
+            "blocksize": self.block_size,
+            "percdamp": self.dampening_frac,
+            "sequential_update": self.sequential_update,
+            "quantize": self.quantize,
+            "calib_dtype": calib_dtype,
+        }
+        for idx, (name, layer) in enumerate(self.compressible_layers_):
             if "outputs" not in accum_kwargs:
                 raise RuntimeError(
                     "The 'outputs' key is expected but not found from the "
                     "return of the bottom compressor"
                 )
-            inputs = accum_kwargs["outputs"]
-            _LOGGER.info(f"\n===== Compressing layer {idx}/{num_layers-1} =====")
-            args = {
-                "sparsity": self.sparsity,
-                "prunen": self.prunen,
-                "prunem": self.prunem,
-                "blocksize": self.block_size,
-                "percdamp": self.dampening_frac,
-                "sequential_update": self.sequential_update,
-                "quantize": self.quantize,
-            }
+            # pop the previous layer outputs so the layer compressor holds the only
+            # reference, letting it overwrite them in place with this layer's outputs
+            inputs = accum_kwargs.pop("outputs")
+            _LOGGER.info(
+                "\n===== Compressing layer %d/%d (%s) =====", idx, num_layers - 1, name
+            )
             layer_compressor = LayerCompressor(self.model, layer, idx, inputs, args)
 
             # Prune/quantize using SparseGPT
@@ -151,7 +197,8 @@ class SparseGPTModifierPyTorch(SparseGPTModifier):
         :param state: un-used, for matching spec of Modifier base class
         """
         use_cache = self.finalization_kwargs_.get("use_cache", False)
-        self.model.apply(torch.quantization.disable_observer)
+        for observer in self.observers_:
+            torch.quantization.disable_observer(observer)
         self.model.config.use_cache = use_cache
 
         return True
@@ -163,6 +210,7 @@ class SparseGPTModifierPyTorch(SparseGPTModifier):
         dev: str = "cuda:0",
         target_ids: List[str] = None,
         layer_prefix: str = None,
+        prefetch_batches: int = 0,
     ) -> Dict:
         """
         Runs calibration data through the bottom part of the network (everything up
@@ -171,10 +219,18 @@ class SparseGPTModifierPyTorch(SparseGPTModifier):
         :param dataloader: calibration data to pass through the model
         :nsamples: number of samples to use for calibration, or None to use it all
         :dev: device to use
+        :prefetch_batches: number of calibration batches to copy to the device ahead
+            of the one in use
         :return: outputs from bottom part of network, attention mask, and kv-cache state
         """
         cached_inputs = cache_attention_inputs(
-            self.model, dataloader, dev, nsamples, target_ids, layer_prefix
+            self.model,
+            dataloader,
+            dev,
+            nsamples,
+            target_ids,
+            layer_prefix,
+            prefetch_batches,
         )
 
         outputs = cached_inputs.pop("inputs")
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 import logging
+from collections import deque
+from itertools import islice
 from math import ceil
 
 import torch
@@ -51,17 +53,77 @@ def replace_module(model, old_module, new_module):
     setattr(current_module, module_name[-1], new_module)
 
 
-def catch(model, attention_layer, target_keys, data_loader, nsamples):
+def prefetch_to_device(data_loader, device, prefetch_batches=0):
+    """
+    Yield the inputs from data_loader moved to device. On GPU, up to
+    prefetch_batches inputs are copied ahead from pinned memory on a separate
+    stream so the host to device copies overlap with the forward passes
+
+    :param data_loader: iterable of input tensors or tuples with the input first
+    :param device: device to move the inputs to
+    :param prefetch_batches: number of inputs to copy ahead of the one in use,
+        0 to copy each input when it is requested
+    """
+    if prefetch_batches <= 0 or torch.device(device).type != "cuda":
+        for inp in data_loader:
+            if isinstance(inp, tuple):
+                inp = inp[0]
+            yield inp.to(device)
+        return
+
+    copy_stream = torch.cuda.Stream(device=device)
+    prefetched = deque()
+
+    def _ready(inp, copied):
+        current_stream = torch.cuda.current_stream()
+        current_stream.wait_event(copied)
+        # inp was allocated on the copy stream but is consumed on this one
+        inp.record_stream(current_stream)
+        return inp
+
+    for inp in data_loader:
+        if isinstance(inp, tuple):
+            inp = inp[0]
+        if inp.device.type == "cpu" and not inp.is_pinned():
+            inp = inp.pin_memory()
+        with torch.cuda.stream(copy_stream):
+            inp = inp.to(device, non_blocking=True)
+            prefetched.append((inp, copy_stream.record_event()))
+        if len(prefetched) > prefetch_batches:
+            yield _ready(*prefetched.popleft())
+
+    while prefetched:
+        yield _ready(*prefetched.popleft())
+
+
+def downcast_calibration_inputs(inputs, dtype):
+    """
+    Cast the calibration inputs to dtype in place, so only one copy of a sample is
+    alive at a time. Skipped unless dtype uses fewer bits than the inputs
+
+    :return: the dtype the inputs are now stored in, None if they were left as is
+    """
+    if dtype is None or not inputs:
+        return None
+    if torch.finfo(dtype).bits >= torch.finfo(inputs[0].dtype).bits:
+        return None
+
+    for idx, inp in enumerate(inputs):
+        inputs[idx] = inp.to(dtype)
+    return dtype
+
+
+def catch(
+    model, attention_layer, target_keys, data_loader, nsamples, prefetch_batches=0
+):
     catcher_module = Catcher(attention_layer, target_keys)
     replace_module(model, attention_layer, catcher_module)
     device = next(attention_layer.parameters()).device
-    for input_id, inp in enumerate(data_loader):
-        if nsamples is not None and input_id == nsamples:
-            break
+    if nsamples is not None:
+        data_loader = islice(data_loader, nsamples)
+    for inp in prefetch_to_device(data_loader, device, prefetch_batches):
         try:
-            if isinstance(inp, tuple):
-                inp = inp[0]
-            model(inp.to(device), use_cache=False)
+            model(inp, use_cache=False)
         except ValueError:
             pass
     replace_module(model, catcher_module, attention_layer)
@@ -109,7 +171,7 @@ def execute_offloaded_module(
 
 
 def cache_attention_inputs(
-    model, dataloader, device, nsamples, target_ids, layer_prefix
+    model, dataloader, device, nsamples, target_ids, layer_prefix, prefetch_batches=0
 ):
     if layer_prefix:
         embed_tokens = getattr(model.model, layer_prefix).embed_tokens
@@ -125,6 +187,7 @@ def cache_attention_inputs(
         target_ids,  # ["attention_mask"],
         dataloader,
         nsamples,
+        prefetch_batches,
     )
     embed_tokens.cpu()
     first_layer.cpu()
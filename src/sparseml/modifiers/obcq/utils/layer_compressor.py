@@ -41,7 +41,8 @@ class LayerCompressor:
     :param model: model containing the layer we are running compression on
     :param layer: layer to run compression on
     :param layer_index: index of layer in the model
-    :param inputs: calibration data to pass through the layer
+    :param inputs: calibration data to pass through the layer, outputs are stored
+        back in the dtype of args["calib_dtype"] if given
     :param args: additional keyword arguments
     """
 
@@ -53,6 +54,8 @@ class LayerCompressor:
         self.layer_index = layer_index
         self.inputs = inputs
         self.args = args
+        self.layer_dtype = next(layer.parameters()).dtype
+        self.calib_dtype = args.get("calib_dtype")
 
     def compressible_modules(self) -> Dict:
         """
@@ -69,6 +72,18 @@ class LayerCompressor:
             modules = _find_layers(self.layer)
         return modules
 
+    def layer_input(self, sample_idx: int) -> torch.Tensor:
+        """
+        Get a calibration sample in the dtype of the layer, inputs may be stored in a
+        lower precision between layers when calib_dtype is set
+
+        :param sample_idx: index of the calibration sample
+        :return: calibration sample to pass through the layer
+        """
+        if self.calib_dtype is None:
+            return self.inputs[sample_idx]
+        return self.inputs[sample_idx].to(self.layer_dtype)
+
     def pre_compress_parallel(self, **kwargs) -> Dict:
         """
         Sets up the SparseGPT objects for each compressible module, computes the Hessian
@@ -103,7 +118,7 @@ class LayerCompressor:
                     passed_in_kwargs[arg] = kwargs[arg][sample_idx]
                 else:
                     passed_in_kwargs[arg] = kwargs[arg]
-            self.layer(self.inputs[sample_idx], **passed_in_kwargs)
+            self.layer(self.layer_input(sample_idx), **passed_in_kwargs)
         for h in handles:
             h.remove()
 
@@ -120,8 +135,27 @@ class LayerCompressor:
             # compute Hessians ahead of time
             extras = self.pre_compress_parallel(**kwargs)
             gpts = extras["gpts"]
-            for name in gpts:
-                _LOGGER.info(f"Compressing {name}...")
+            names = list(gpts.keys())
+
+            # the Hessians are independent of each other, so on GPU the inverse of
+            # the next module's Hessian is computed on a side stream while the
+            # current module is pruned
+            compute_stream = (
+                torch.cuda.Stream(device=dev)
+                if torch.device(dev).type == "cuda"
+                else None
+            )
+            inverse_ready = None
+            for idx, name in enumerate(names):
+                if inverse_ready is not None:
+                    torch.cuda.current_stream().wait_event(inverse_ready)
+                    inverse_ready = None
+                if compute_stream is not None and idx + 1 < len(names):
+                    inverse_ready = _compute_hessian_inverse_async(
+                        gpts[names[idx + 1]], self.args["percdamp"], compute_stream
+                    )
+
+                _LOGGER.info("Compressing %s...", name)
                 sparsity = self.args["sparsity"]
                 gpts[name].fasterprune(
                     sparsity,
@@ -141,12 +175,12 @@ class LayerCompressor:
 
     def post_compress(self, **kwargs) -> Dict:
         """
-        Clean up after compression
+        Clean up after compression. The layer inputs are overwritten in place by
+        the layer outputs so only one layer's worth of calibration data is alive
 
         :return: outputs of the layer
         """
         nsamples = len(self.inputs)
-        outputs = []
         forward_args_spec = inspect.getfullargspec(self.layer.__class__.forward)
         passed_in_args = [arg for arg in forward_args_spec.args if arg in kwargs]
         for j in range(nsamples):
@@ -156,8 +190,12 @@ class LayerCompressor:
                     passed_in_kwargs[arg] = kwargs[arg][j]
                 else:
                     passed_in_kwargs[arg] = kwargs[arg]
-            outputs.append(self.layer(self.inputs[j], **passed_in_kwargs)[0])
+            output = self.layer(self.layer_input(j), **passed_in_kwargs)[0]
+            if self.calib_dtype is not None:
+                output = output.to(self.calib_dtype)
+            self.inputs[j] = output
 
+        outputs = self.inputs
         self.inputs = None
         torch.cuda.empty_cache()
         return {"outputs": outputs}
@@ -182,7 +220,7 @@ class LayerCompressor:
             else:
                 passed_in_kwargs[arg] = kwargs[arg]
         order = get_dependency_order(
-            self.layer, subset, self.inputs[0], **passed_in_kwargs
+            self.layer, subset, self.layer_input(0), **passed_in_kwargs
         )
 
         nsamples = len(self.inputs)
@@ -205,10 +243,10 @@ class LayerCompressor:
                     else:
                         passed_in_kwargs[arg] = kwargs[arg]
                 # run layer, triggering SparseGPT add_batch for current module
-                self.layer(self.inputs[sample_idx], **passed_in_kwargs)
+                self.layer(self.layer_input(sample_idx), **passed_in_kwargs)
             handle.remove()
 
-            _LOGGER.info(f"Compressing module {name} of layer {self.layer_index}")
+            _LOGGER.info("Compressing module %s of layer %d", name, self.layer_index)
             gpts.fasterprune(  # run SparseGPT algorithm on current module
                 self.args["sparsity"],
                 prunen=self.args["prunen"],
@@ -219,28 +257,52 @@ class LayerCompressor:
             gpts.free()
 
 
+def _compute_hessian_inverse_async(
+    gpt: SparseGPT, percdamp: float, stream: torch.cuda.Stream
+) -> torch.cuda.Event:
+    """
+    Queue the Hessian inverse of gpt on stream, after all work currently queued on
+    the current stream
+
+    :return: event to wait on before the inverse is used on the current stream
+    """
+    current_stream = torch.cuda.current_stream()
+    stream.wait_stream(current_stream)
+    # H is allocated on the current stream but consumed and released on stream
+    gpt.H.record_stream(stream)
+    with torch.cuda.stream(stream):
+        gpt.compute_hessian_inverse(percdamp)
+        inverse_ready = stream.record_event()
+    # the inverse is allocated on stream but consumed on the current stream
+    gpt.Hinv.record_stream(current_stream)
+    gpt.dead.record_stream(current_stream)
+    gpt.cholesky_info.record_stream(current_stream)
+
+    return inverse_ready
+
+
 def _find_quant_layers(
     module, layers=[torch.nn.qat.Conv2d, torch.nn.qat.Linear], name=""
 ):
     res = {}
+    parts = (name,) if name != "" else ()
     # search for QAT versions of layers
     for name1, child in module.named_children():
-        res.update(
-            _find_layers(
-                child, layers=layers, name=name + "." + name1 if name != "" else name1
-            )
-        )
+        _update_layers(child, layers, res, parts + (name1,))
     return res
 
 
 def _find_layers(module, layers=[nn.Conv2d, nn.Linear], name=""):
-    if type(module) in layers:
-        return {name: module}
     res = {}
-    for name1, child in module.named_children():
-        res.update(
-            _find_layers(
-                child, layers=layers, name=name + "." + name1 if name != "" else name1
-            )
-        )
+    _update_layers(module, layers, res, (name,) if name != "" else ())
     return res
+
+
+def _update_layers(module, layers, cached_layers, parts):
+    # name parts are only joined for matched layers, rather than concatenating
+    # the dotted name at every level of the recursion
+    if type(module) in layers:
+        cached_layers[".".join(parts)] = module
+        return
+    for name, child in module.named_children():
+        _update_layers(child, layers, cached_layers, parts + (name,))
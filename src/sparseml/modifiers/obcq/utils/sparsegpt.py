@@ -33,6 +33,7 @@ class SparseGPT:
 
     Lifecycle:
         - add_batch
+        - compute_hessian_inverse (optional, otherwise run by fasterprune)
         - fasterprune
         - free
 
@@ -53,6 +54,9 @@ class SparseGPT:
         self.rows = W.shape[0]
         self.columns = W.shape[1]
         self.H = torch.zeros((self.columns, self.columns), device=self.dev)
+        self.Hinv = None
+        self.dead = None
+        self.cholesky_info = None
         self.nsamples = 0
 
     def add_batch(self, inp: torch.Tensor, out: torch.Tensor):
@@ -81,6 +85,31 @@ class SparseGPT:
         inp = math.sqrt(2 / self.nsamples) * inp.float()
         self.H += inp.matmul(inp.t())
 
+    def compute_hessian_inverse(self, percdamp: float = 0.01):
+        """
+        Dampen the accumulated Hessian and compute the upper Cholesky factor of its
+        inverse. Independent of the layer weights and free of host syncs, so it can
+        be run ahead of fasterprune, i.e. on a separate CUDA stream
+
+        :param percdamp: Amount of dampening to apply to H, as a fraction of the
+        diagonal norm
+        """
+        H = self.H
+        del self.H
+        dead = torch.diag(H) == 0
+        H.diagonal().masked_fill_(dead, 1)
+
+        damp = percdamp * torch.mean(torch.diag(H))
+        diag = torch.arange(self.columns, device=self.dev)
+        H[diag, diag] += damp
+        H, info = torch.linalg.cholesky_ex(H)
+        H = torch.cholesky_inverse(H)
+        H, inv_info = torch.linalg.cholesky_ex(H, upper=True)
+        self.Hinv = H
+        self.dead = dead
+        # checked in fasterprune, once the inverse is actually needed
+        self.cholesky_info = info + inv_info
+
     def fasterprune(
         self,
         sparsity: float,
@@ -111,22 +140,18 @@ class SparseGPT:
 
         tick = time.time()
 
-        H = self.H
-        del self.H
-        dead = torch.diag(H) == 0
-        H[dead, dead] = 1
-        W[:, dead] = 0
+        if self.Hinv is None:
+            self.compute_hessian_inverse(percdamp)
+        if self.cholesky_info.item() != 0:
+            raise RuntimeError(
+                "Cholesky decomposition of the dampened Hessian failed, the matrix "
+                "is not positive-definite. Try increasing the dampening_frac"
+            )
+        Hinv = self.Hinv
+        W[:, self.dead] = 0
 
         Losses = torch.zeros(self.rows, device=self.dev)
 
-        damp = percdamp * torch.mean(torch.diag(H))
-        diag = torch.arange(self.columns, device=self.dev)
-        H[diag, diag] += damp
-        H = torch.linalg.cholesky(H)
-        H = torch.cholesky_inverse(H)
-        H = torch.linalg.cholesky(H, upper=True)
-        Hinv = H
-
         mask = None
 
         # See section 3.4 of https://arxiv.org/abs/2203.07259
@@ -137,34 +162,35 @@ class SparseGPT:
             W1 = W[:, i1:i2].clone()
             Q1 = torch.zeros_like(W1)
             Err1 = torch.zeros_like(W1)
-            Losses1 = torch.zeros_like(W1)
             Hinv1 = Hinv[i1:i2, i1:i2]
+            Hinv1_diag = torch.diag(Hinv1)
 
             if prunen == 0:
                 if mask is not None:
                     mask1 = mask[:, i1:i2]
                 else:
-                    tmp = W1**2 / (torch.diag(Hinv1).reshape((1, -1))) ** 2
+                    tmp = W1**2 / (Hinv1_diag.reshape((1, -1))) ** 2
                     thresh = torch.sort(tmp.flatten())[0][int(tmp.numel() * sparsity)]
                     mask1 = tmp <= thresh
             else:
-                mask1 = torch.zeros_like(W1) == 1
+                # filled in one N:M group at a time as the columns are updated
+                mask1 = torch.zeros_like(W1, dtype=torch.bool)
 
             for i in range(count):
                 w = W1[:, i]
-                d = Hinv1[i, i]
+                d = Hinv1_diag[i]
 
                 if prunen != 0 and i % prunem == 0:
                     tmp = (
                         W1[:, i : (i + prunem)] ** 2
-                        / (torch.diag(Hinv1)[i : (i + prunem)].reshape((1, -1))) ** 2
+                        / (Hinv1_diag[i : (i + prunem)].reshape((1, -1))) ** 2
                     )
                     mask1.scatter_(
                         1, i + torch.topk(tmp, prunen, dim=1, largest=False)[1], True
                     )
 
-                q = w.clone()
-                q[mask1[:, i]] = 0
+                # masked_fill rather than boolean indexing to avoid a host sync
+                q = w.masked_fill(mask1[:, i], 0)
 
                 if hasattr(self.layer, "weight_fake_quant"):
                     scale = self.layer.weight_fake_quant.scale
@@ -178,14 +204,14 @@ class SparseGPT:
                     q = torch.dequantize(q)
 
                 Q1[:, i] = q
-                Losses1[:, i] = (w - q) ** 2 / d**2
-
                 err1 = (w - q) / d
-                W1[:, i:] -= err1.unsqueeze(1).matmul(Hinv1[i, i:].unsqueeze(0))
                 Err1[:, i] = err1
+                # in-place rank-1 update of the remaining columns in the block
+                W1[:, i:].addr_(err1, Hinv1[i, i:], alpha=-1)
 
             W[:, i1:i2] = Q1
-            Losses += torch.sum(Losses1, 1) / 2
+            # per column loss is (w - q) ** 2 / d ** 2, which is Err1 ** 2
+            Losses += torch.sum(Err1**2, 1) / 2
 
             W[:, i2:] -= Err1.matmul(Hinv[i1:i2, i2:])
 
@@ -215,4 +241,7 @@ class SparseGPT:
             self._inp1 = None
             self.out1 = None
         self.H = None
+        self.Hinv = None
+        self.dead = None
+        self.cholesky_info = None
         torch.cuda.empty_cache()
@@ -18,9 +18,11 @@ Modifier for performing knowledge distillation via feature imitation.
 
 import logging
 from copy import deepcopy
-from typing import Dict, List, Optional, Union
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import torch
+import torch.nn.functional as TF
 from torch.nn import Module
 from torch.utils.hooks import RemovableHandle
 
@@ -29,7 +31,7 @@ from sparseml.pytorch.sparsification.distillation.modifier_distillation_base imp
     BaseDistillationModifier,
 )
 from sparseml.pytorch.sparsification.modifier import PyTorchModifierYAML
-from sparseml.pytorch.utils import BaseLogger
+from sparseml.pytorch.utils import BaseLogger, get_floating_point_dtype
 
 
 __all__ = [
@@ -40,7 +42,7 @@ __all__ = [
 DISTILL_PARAM_GROUP_KEY = "distillation_projection_params"
 
 _LOGGER = logging.getLogger(__name__)
-_DISTILLATION_TYPES = [torch.nn.Conv2d, torch.nn.Linear]
+_DISTILLATION_TYPES = frozenset([torch.nn.Conv2d, torch.nn.Linear])
 
 
 @PyTorchModifierYAML()
@@ -95,6 +97,15 @@ class PerLayerDistillationModifier(BaseDistillationModifier):
         Default is `True`
     :param epsilon: Small value used to avoid division by zero when normalization
         is used. Default is `1e-6`
+    :param cache_dtype: Optional name of the floating point dtype to cast the
+        teacher layer outputs to, i.e. `"bfloat16"` or `"float16"`. If not set,
+        teacher outputs are cast to the autocast dtype whenever autocast is enabled.
+        Student outputs are never cast, they are kept alive by the student's graph
+        regardless. Default is `None`
+    :param streaming_loss: Whether to compute each layer's loss as soon as the
+        teacher layer runs, in which case teacher outputs are not cached. Relies on
+        the student forward pass running before the teacher's, as it does in
+        loss_update. Default is `True`
     """
 
     def __init__(
@@ -108,6 +119,8 @@ class PerLayerDistillationModifier(BaseDistillationModifier):
         teacher_layer_names: Optional[List[str]] = None,
         project_features: bool = True,
         epsilon: float = 1e-6,
+        cache_dtype: Optional[str] = None,
+        streaming_loss: bool = True,
     ):
         if (
             student_layer_names is not None
@@ -145,14 +158,24 @@ class PerLayerDistillationModifier(BaseDistillationModifier):
         self._teacher_layer_names = teacher_layer_names
         self._project_features = project_features
         self._epsilon = epsilon
+        self._cache_dtype = cache_dtype
+        self._streaming_loss = streaming_loss
 
-        self._cached_student_output: Dict[str, torch.Tensor] = {}
-        self._cached_teacher_output: Dict[str, torch.Tensor] = {}
+        self._layer_pairs: List[Tuple[int, int]] = []
+        self._cached_student_output: Dict[int, torch.Tensor] = {}
+        self._cached_teacher_output: Dict[int, torch.Tensor] = {}
         self._student_handles: List[RemovableHandle] = []
         self._teacher_handles: List[RemovableHandle] = []
-        self._projection: Dict[str, torch.nn.Module] = {}
-        self._student_output_shapes: Dict[str, torch.Size] = {}
-        self._teacher_output_shapes: Dict[str, torch.Size] = {}
+        self._projection: Dict[int, torch.nn.Module] = {}
+        self._projection_groups: List[List[int]] = []
+        self._student_output_shapes: Dict[int, torch.Size] = {}
+        self._teacher_output_shapes: Dict[int, torch.Size] = {}
+        self._streamed_losses: Dict[int, torch.Tensor] = {}
+        self._projected_student_output: Dict[int, torch.Tensor] = {}
+        self._awaiting_teacher = False
+        self._layer_loss_fn: Optional[
+            Callable[[torch.Tensor, torch.Tensor], torch.Tensor]
+        ] = None
         self._loaded_projection = None
 
     def _reset_cache(self):
@@ -161,8 +184,12 @@ class PerLayerDistillationModifier(BaseDistillationModifier):
         self._student_handles.clear()
         self._teacher_handles.clear()
         self._projection.clear()
+        self._projection_groups.clear()
         self._student_output_shapes.clear()
         self._teacher_output_shapes.clear()
+        self._streamed_losses.clear()
+        self._projected_student_output.clear()
+        self._awaiting_teacher = False
 
     @ModifierProp()
     def gain(self) -> float:
@@ -255,11 +282,43 @@ class PerLayerDistillationModifier(BaseDistillationModifier):
         """
         self._project_features = value
 
+    @ModifierProp()
+    def cache_dtype(self) -> Optional[str]:
+        """
+        :return: name of the dtype to cast the teacher layer outputs to, or None
+            to cast to the autocast dtype when autocast is enabled
+        """
+        return self._cache_dtype
+
+    @cache_dtype.setter
+    def cache_dtype(self, value: Optional[str]):
+        """
+        :param value: name of the dtype to cast the teacher layer outputs to, or
+            None to cast to the autocast dtype when autocast is enabled
+        """
+        self._cache_dtype = value
+
+    @ModifierProp()
+    def streaming_loss(self) -> bool:
+        """
+        :return: Whether to compute each layer's loss as soon as the teacher layer
+            runs instead of caching the teacher outputs
+        """
+        return self._streaming_loss
+
+    @streaming_loss.setter
+    def streaming_loss(self, value: bool):
+        """
+        :param value: Whether to compute each layer's loss as soon as the teacher
+            layer runs instead of caching the teacher outputs
+        """
+        self._streaming_loss = value
+
     def state_dict(self) -> Dict[str, Dict]:
         state = super().state_dict()
         if self.project_features:
             state[DISTILL_PARAM_GROUP_KEY] = {
-                name: p.state_dict() for name, p in self._projection.items()
+                name: p.state_dict() for name, p in self._named_projections().items()
             }
         return state
 
@@ -300,6 +359,14 @@ class PerLayerDistillationModifier(BaseDistillationModifier):
         if distillation_teacher == "self":
             self._teacher = deepcopy(module)
 
+        # the teacher is never trained, keep autograd from tracking it even if it is
+        # run outside of loss_update's no_grad context. Parameters it shares with
+        # the student, i.e. through tied or wrapped modules, are left trainable
+        student_params = {id(param) for param in module.parameters()}
+        for param in self._teacher.parameters():
+            if id(param) not in student_params:
+                param.requires_grad_(False)
+
         self._reset_cache()
 
         cached_student_layers: Dict[str, torch.nn.Module] = {}
@@ -327,24 +394,64 @@ class PerLayerDistillationModifier(BaseDistillationModifier):
                 "Found different numbers of teacher and student layers to distill. "
                 "Set teacher_layer_names and student_layer_names explicitly."
             )
+        # resolve the student and teacher pairing once for the per step loss. The
+        # hooks cache outputs under the id of their layer, so the layer names are
+        # only translated here
+        student_layer_ids = {
+            name: id(layer) for name, layer in cached_student_layers.items()
+        }
+        teacher_layer_ids = {
+            name: id(layer) for name, layer in cached_teacher_layers.items()
+        }
+        self._layer_pairs = [
+            (student_layer_ids[student_name], teacher_layer_ids[teacher_name])
+            for student_name, teacher_name in zip(
+                self._student_layer_names, self._teacher_layer_names
+            )
+        ]
 
+        cache_dtype = get_floating_point_dtype(self._cache_dtype)
+        # student outputs are referenced by the student's graph until backward, a
+        # lower precision copy would only add to their memory
         self._student_handles = [
-            layer.register_forward_hook(
-                _create_cache_output_hook(
-                    name, self._cached_student_output, self._student_output_shapes
-                )
-            )
-            for name, layer in cached_student_layers.items()
+            layer.register_forward_hook(self._create_student_output_hook(id(layer)))
+            for layer in cached_student_layers.values()
         ]
 
-        self._teacher_handles = [
-            layer.register_forward_hook(
-                _create_cache_output_hook(
-                    name, self._cached_teacher_output, self._teacher_output_shapes
+        # like the other ModifierProps, streaming_loss can't be changed once the
+        # modifier is initialized, so the teacher hooks are only picked here
+        if self._streaming_loss:
+            teacher_pair_indices: Dict[int, List[int]] = {}
+            for index, (_, teacher_id) in enumerate(self._layer_pairs):
+                teacher_pair_indices.setdefault(teacher_id, []).append(index)
+            self._teacher_handles = [
+                layer.register_forward_hook(
+                    self._create_streaming_loss_hook(
+                        id(layer), teacher_pair_indices[id(layer)], cache_dtype
+                    )
                 )
-            )
-            for name, layer in cached_teacher_layers.items()
-        ]
+                for layer in cached_teacher_layers.values()
+            ]
+        else:
+            self._teacher_handles = [
+                layer.register_forward_hook(
+                    _create_cache_output_hook(
+                        id(layer),
+                        self._cached_teacher_output,
+                        self._teacher_output_shapes,
+                        cache_dtype,
+                    )
+                )
+                for layer in cached_teacher_layers.values()
+            ]
+
+        # normalize and epsilon are fixed from here on as well, pick the scripted
+        # loss once instead of branching for every layer of every step
+        self._layer_loss_fn = (
+            partial(_normalized_mse_loss, epsilon=self._epsilon)
+            if self._normalize
+            else _mse_loss
+        )
 
     def update(
         self,
@@ -362,39 +469,144 @@ class PerLayerDistillationModifier(BaseDistillationModifier):
             self._reset_cache()
 
     def compute_total_loss(self, loss, distillation_loss):
-        return loss + self.gain * distillation_loss
+        return loss + self._gain * distillation_loss.to(loss.device)
 
     def compute_distillation_loss(self, optimizer: torch.optim.Optimizer, **kwargs):
-        if self.project_features and len(self._projection) == 0:
+        if not self._layer_pairs:
+            return torch.zeros(())
+
+        if self._project_features and len(self._projection) == 0:
             # NOTE: have to call initialize here because we need the cached output
             # from the module. i.e. we need forward to have been called already
             self._projection = self._initialize_projection()
+            self._projection_groups = _group_projections(self._projection)
 
             if self._loaded_projection is not None:
-                for name, layer in self._projection.items():
+                for name, layer in self._named_projections().items():
                     layer.load_state_dict(self._loaded_projection.pop(name))
                 self._loaded_projection = None
 
         self._patch_state_dict_loading(optimizer)
 
-        distillation_loss = 0.0
-        for student_name, teacher_name in zip(
-            self._student_layer_names, self._teacher_layer_names
-        ):
-            student_output = self._cached_student_output[student_name]
-            if self.project_features:
-                student_output = self._projection[student_name](student_output.float())
-
-            teacher_output = self._cached_teacher_output[teacher_name]
+        student_outputs = None
+        layer_losses = []
+        for index, (student_id, teacher_id) in enumerate(self._layer_pairs):
+            if index in self._streamed_losses:
+                layer_losses.append(self._streamed_losses[index])
+                continue
+
+            if student_outputs is None:
+                student_outputs = self._get_student_outputs()
+            student_output = student_outputs[student_id]
+            teacher_output = self._cached_teacher_output[teacher_id]
+
+            layer_losses.append(self._layer_loss_fn(student_output, teacher_output))
+        self._streamed_losses.clear()
+        self._projected_student_output.clear()
+        self._awaiting_teacher = False
+        if self._streaming_loss:
+            # only used as a fallback while streaming, don't keep it alive
+            self._cached_teacher_output.clear()
+
+        # layers, and so their losses, may be spread across devices
+        device = layer_losses[-1].device
+        return torch.stack([loss.to(device) for loss in layer_losses]).sum()
+
+    def _create_student_output_hook(self, student_id: int):
+        def forward_hook_fn(layer, inp, out):
+            if student_id not in self._student_output_shapes:
+                self._student_output_shapes[student_id] = out.shape
+            # a student forward starts a new step, drop anything the streaming
+            # hooks computed from the previous step's outputs
+            self._streamed_losses.clear()
+            self._projected_student_output.clear()
+            self._awaiting_teacher = True
+            self._cached_student_output[student_id] = out
+
+        return forward_hook_fn
+
+    def _create_streaming_loss_hook(
+        self,
+        teacher_id: int,
+        pair_indices: List[int],
+        cache_dtype: Optional[torch.dtype],
+    ):
+        def forward_hook_fn(layer, inp, out):
+            if teacher_id not in self._teacher_output_shapes:
+                self._teacher_output_shapes[teacher_id] = out.shape
+            if not self._awaiting_teacher:
+                # teacher run outside of a distillation step, e.g. for evaluation,
+                # there is no new student output to compute a loss against
+                return
+            out = _cast_cached_output(out.detach(), cache_dtype)
+
+            if self._project_features and len(self._projection) == 0:
+                # projections are created from the output shapes seen in the first
+                # step, until then fall back to caching the teacher output
+                self._cached_teacher_output[teacher_id] = out
+                return
+
+            # the teacher runs under no_grad, but the loss needs the student graph
+            with torch.enable_grad():
+                student_outputs = None
+                for index in pair_indices:
+                    student_id = self._layer_pairs[index][0]
+                    if student_id not in self._cached_student_output:
+                        self._cached_teacher_output[teacher_id] = out
+                        continue
+
+                    if student_outputs is None:
+                        student_outputs = self._get_student_outputs()
+                    self._streamed_losses[index] = self._layer_loss_fn(
+                        student_outputs[student_id], out
+                    )
+
+        return forward_hook_fn
+
+    def _get_student_outputs(self) -> Dict[int, torch.Tensor]:
+        if not self._project_features:
+            return self._cached_student_output
+
+        # the student forward has finished by the time the first teacher hook runs,
+        # so all projections for the step are run at once on first use, keeping
+        # the grouped convolutions when streaming
+        if not self._projected_student_output:
+            self._projected_student_output.update(self._project_student_outputs())
+        return self._projected_student_output
+
+    def _project_student_outputs(self) -> Dict[int, torch.Tensor]:
+        projected = {}
+        for group in self._projection_groups:
+            # projections in a group share their channel counts, so activations
+            # that also share batch and spatial dims can run as a single grouped
+            # 1x1 convolution instead of one launch per layer
+            buckets = {}
+            for layer_id in group:
+                if layer_id not in self._cached_student_output:
+                    continue
+                output = self._cached_student_output[layer_id].float()
+                buckets.setdefault((output.shape, output.device), []).append(
+                    (layer_id, output)
+                )
 
-            output_mse = (student_output - teacher_output).square().mean()
-            if self.normalize:
-                teacher_output_magnitude = teacher_output.square().mean()
-                output_mse /= teacher_output_magnitude + self.epsilon
+            for bucket in buckets.values():
+                if len(bucket) == 1:
+                    layer_id, output = bucket[0]
+                    projected[layer_id] = self._projection[layer_id](output)
+                    continue
 
-            distillation_loss += output_mse
+                layer_ids, outputs = zip(*bucket)
+                weight = torch.cat(
+                    [self._projection[layer_id].weight for layer_id in layer_ids]
+                )
+                grouped_output = TF.conv2d(
+                    torch.cat(outputs, dim=1), weight, groups=len(layer_ids)
+                )
+                projected.update(
+                    zip(layer_ids, grouped_output.chunk(len(layer_ids), dim=1))
+                )
 
-        return distillation_loss
+        return projected
 
     def _patch_state_dict_loading(self, optimizer):
         if _get_projection_param_group_idx(optimizer.param_groups) is None:
@@ -436,27 +648,38 @@ class PerLayerDistillationModifier(BaseDistillationModifier):
             optimizer.state_dict = state_dict_without_projection
             optimizer.load_state_dict = load_state_dict_without_projection
 
-    def _initialize_projection(self) -> Dict[str, torch.Tensor]:
-        device = self._cached_student_output[self.student_layer_names[0]].device
+    def _named_projections(self) -> Dict[str, torch.nn.Module]:
+        # projections are keyed by student layer id, but saved by layer name
+        if not self._projection:
+            return {}
+        return {
+            name: self._projection[student_id]
+            for name, (student_id, _) in zip(
+                self._student_layer_names, self._layer_pairs
+            )
+            if student_id in self._projection
+        }
 
+    def _initialize_projection(self) -> Dict[int, torch.nn.Module]:
         assert len(self._student_output_shapes) == len(self._student_layer_names)
         assert len(self._teacher_output_shapes) == len(self._teacher_layer_names)
 
         projections = {}
-        for student_name, teacher_name in zip(
-            self._student_layer_names, self._teacher_layer_names
-        ):
-            student_shape = self._student_output_shapes[student_name]
-            teacher_shape = self._teacher_output_shapes[teacher_name]
+        for student_id, teacher_id in self._layer_pairs:
+            student_shape = self._student_output_shapes[student_id]
+            teacher_shape = self._teacher_output_shapes[teacher_id]
+            # placed once on the device of the layer it projects, so no per step
+            # moves are needed even when the model is spread across devices
+            device = self._cached_student_output[student_id].device
             if len(student_shape) == 4:
-                projections[student_name] = torch.nn.Conv2d(
+                projections[student_id] = torch.nn.Conv2d(
                     in_channels=student_shape[1],
                     out_channels=teacher_shape[1],
                     kernel_size=1,
                     bias=False,
                 ).to(device)
             else:
-                projections[student_name] = torch.nn.Linear(
+                projections[student_id] = torch.nn.Linear(
                     in_features=student_shape[-1],
                     out_features=teacher_shape[-1],
                     bias=False,
@@ -465,49 +688,92 @@ class PerLayerDistillationModifier(BaseDistillationModifier):
         return projections
 
 
+# the losses are scripted so the subtract, square and reduce can be fused into a
+# single pass over the cached activations. Kept as separate branch free functions
+# so neither graph is split by a runtime check on normalize
+@torch.jit.script
+def _mse_loss(
+    student_output: torch.Tensor, teacher_output: torch.Tensor
+) -> torch.Tensor:
+    diff = student_output - teacher_output
+    return (diff * diff).mean()
+
+
+@torch.jit.script
+def _normalized_mse_loss(
+    student_output: torch.Tensor, teacher_output: torch.Tensor, epsilon: float
+) -> torch.Tensor:
+    diff = student_output - teacher_output
+    return (diff * diff).mean() / ((teacher_output * teacher_output).mean() + epsilon)
+
+
+def _group_projections(projections: Dict[int, torch.nn.Module]) -> List[List[int]]:
+    """
+    :return: student layer ids of the given projections grouped so that 1x1
+        convolutions with the same input and output channels on the same device
+        share a group. All other projections are placed in a group of their own
+    """
+    groups = {}
+    for layer_id, projection in projections.items():
+        key = (
+            (tuple(projection.weight.shape), projection.weight.device)
+            if isinstance(projection, torch.nn.Conv2d)
+            else layer_id
+        )
+        groups.setdefault(key, []).append(layer_id)
+    return list(groups.values())
+
+
 def _create_cache_output_hook(
-    layer_name: str,
-    outputs: Dict[str, torch.Tensor],
-    outputs_shape: Dict[str, torch.Size],
+    layer_id: int,
+    outputs: Dict[int, torch.Tensor],
+    outputs_shape: Dict[int, torch.Size],
+    cache_dtype: Optional[torch.dtype] = None,
 ):
     def forward_hook_fn(layer, inp, out):
-        outputs[layer_name] = out
-        if layer_name not in outputs_shape:
-            outputs_shape[layer_name] = out.shape
+        if layer_id not in outputs_shape:
+            outputs_shape[layer_id] = out.shape
+        # no graph needs the teacher outputs, so only the cast copy is kept
+        outputs[layer_id] = _cast_cached_output(out.detach(), cache_dtype)
 
     return forward_hook_fn
 
 
+def _cast_cached_output(
+    out: torch.Tensor, cache_dtype: Optional[torch.dtype]
+) -> torch.Tensor:
+    if cache_dtype is not None:
+        return out.to(cache_dtype)
+    if torch.is_autocast_enabled():
+        return out.to(_get_autocast_dtype())
+    return out
+
+
+def _get_autocast_dtype() -> torch.dtype:
+    # get_autocast_gpu_dtype is not available before torch 1.10, where autocast
+    # always ran in float16
+    get_autocast_dtype = getattr(torch, "get_autocast_gpu_dtype", None)
+    return get_autocast_dtype() if get_autocast_dtype else torch.float16
+
+
 def _update_layers_by_type(
-    layer_module: torch.nn.Module,
+    module: torch.nn.Module,
     cached_layers: Dict[str, torch.nn.Module],
-    name: str = "",
 ):
-    if type(layer_module) in _DISTILLATION_TYPES:
-        cached_layers[name] = layer_module
-    for layer_module, child in layer_module.named_children():
-        _update_layers_by_type(
-            child,
-            cached_layers,
-            name + "." + layer_module if name != "" else layer_module,
-        )
+    for name, layer in module.named_modules():
+        if type(layer) in _DISTILLATION_TYPES:
+            cached_layers[name] = layer
 
 
 def _update_layers_by_name(
-    layer_module: torch.nn.Module,
+    module: torch.nn.Module,
     layer_names: List[str],
     cached_layers: Dict[str, torch.nn.Module],
-    name: str = "",
 ):
-    if name in layer_names:
-        cached_layers[name] = layer_module
-    for layer_module, child in layer_module.named_children():
-        _update_layers_by_name(
-            child,
-            layer_names,
-            cached_layers,
-            name + "." + layer_module if name != "" else layer_module,
-        )
+    layer_names = set(layer_names)
+    for name, layer in module.named_modules():
+        if name in layer_names:
+            cached_layers[name] = layer
 
 
 def _get_projection_param_group_idx(param_groups: List[Dict]) -> Optional[int]:
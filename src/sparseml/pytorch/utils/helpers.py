@@ -76,6 +76,7 @@ __all__ = [
     "tensors_batch_size",
     "tensors_to_device",
     "tensors_to_precision",
+    "get_floating_point_dtype",
     "tensors_module_forward",
     "tensor_export",
     "tensors_export",
@@ -374,6 +375,23 @@ def tensors_to_precision(
     )
 
 
+def get_floating_point_dtype(dtype_name: Optional[str]) -> Optional[torch.dtype]:
+    """
+    :param dtype_name: name of a floating point torch dtype, ex: 'bfloat16', or None
+    :return: the torch dtype matching the name, None if no name was given
+    """
+    if dtype_name is None:
+        return None
+
+    dtype = getattr(torch, dtype_name, None)
+    if not isinstance(dtype, torch.dtype) or not dtype.is_floating_point:
+        raise ValueError(
+            "unrecognized floating point dtype given of {}".format(dtype_name)
+        )
+
+    return dtype
+
+
 def tensors_module_forward(
     tensors: Union[Tensor, Iterable[Tensor], Mapping[Any, Tensor]],
     module: Module,
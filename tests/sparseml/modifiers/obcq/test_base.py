@@ -0,0 +1,44 @@
+# Copyright (c) 2021 - present / Neuralmagic, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from sparseml.modifiers.obcq import SparseGPTModifier
+
+
+@pytest.mark.parametrize(
+    "prunen,prunem,block_size", [(0, 0, 128), (2, 4, 128), (2, 4, 4), (4, 8, 64)]
+)
+def test_valid_n_m_config(prunen, prunem, block_size):
+    modifier = SparseGPTModifier(
+        sparsity=0.5,
+        block_size=block_size,
+        quantize=False,
+        prunen=prunen,
+        prunem=prunem,
+    )
+
+    assert modifier.prunem == prunem
+
+
+@pytest.mark.parametrize("prunen,prunem,block_size", [(2, 4, 130), (2, 0, 128)])
+def test_invalid_n_m_config_raises_error(prunen, prunem, block_size):
+    with pytest.raises(ValueError, match="must be a multiple of `prunem`"):
+        SparseGPTModifier(
+            sparsity=0.5,
+            block_size=block_size,
+            quantize=False,
+            prunen=prunen,
+            prunem=prunem,
+        )
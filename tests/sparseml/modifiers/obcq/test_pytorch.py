@@ -0,0 +1,51 @@
+# Copyright (c) 2021 - present / Neuralmagic, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from sparseml.modifiers.obcq.pytorch import SparseGPTModifierPyTorch
+
+
+def test_calib_dtype_default():
+    modifier = SparseGPTModifierPyTorch(sparsity=0.5, block_size=128, quantize=False)
+
+    assert modifier.calib_dtype is None
+
+
+@pytest.mark.parametrize("calib_dtype", ["int8", "not_a_dtype"])
+def test_invalid_calib_dtype_raises_error(calib_dtype):
+    with pytest.raises(ValueError, match="floating point dtype"):
+        SparseGPTModifierPyTorch(
+            sparsity=0.5, block_size=128, quantize=False, calib_dtype=calib_dtype
+        )
+
+
+def test_finalize_disables_observers():
+    fake_quant = torch.quantization.FakeQuantize()
+    scripted_fake_quant = torch.jit.script(torch.quantization.FakeQuantize())
+    # scripted modules are collected without checking what they script
+    scripted_linear = torch.jit.script(torch.nn.Linear(4, 4))
+
+    modifier = SparseGPTModifierPyTorch(sparsity=0.5, block_size=128, quantize=False)
+    modifier.model = SimpleNamespace(config=SimpleNamespace(use_cache=True))
+    modifier.finalization_kwargs_ = {}
+    modifier.observers_ = [fake_quant, scripted_fake_quant, scripted_linear]
+
+    assert modifier.on_finalize(None)
+    assert fake_quant.observer_enabled[0] == 0
+    assert scripted_fake_quant.observer_enabled[0] == 0
+    assert modifier.model.config.use_cache is False
@@ -0,0 +1,105 @@
+# Copyright (c) 2021 - present / Neuralmagic, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+
+from sparseml.modifiers.obcq.utils.helpers import (
+    catch,
+    downcast_calibration_inputs,
+    prefetch_to_device,
+)
+
+
+class _DecoderLayer(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.fc = torch.nn.Linear(8, 8)
+
+    def forward(self, hidden_states, attention_mask=None):
+        return (self.fc(hidden_states),)
+
+
+class _Decoder(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.layers = torch.nn.ModuleList([_DecoderLayer(), _DecoderLayer()])
+
+    def forward(self, input_ids, use_cache=True):
+        hidden_states = input_ids
+        attention_mask = torch.ones(input_ids.shape[:-1])
+        for layer in self.layers:
+            hidden_states = layer(hidden_states, attention_mask=attention_mask)[0]
+        return hidden_states
+
+
+@pytest.mark.parametrize(
+    "input_dtype,dtype,expected_dtype",
+    [
+        (torch.float32, torch.bfloat16, torch.bfloat16),
+        (torch.float32, torch.float16, torch.float16),
+        # same number of bits, nothing would be saved
+        (torch.float16, torch.bfloat16, None),
+        (torch.bfloat16, torch.bfloat16, None),
+        (torch.float16, torch.float32, None),
+        (torch.float32, None, None),
+    ],
+)
+def test_downcast_calibration_inputs(input_dtype, dtype, expected_dtype):
+    inputs = [torch.randn(2, 4, 8).to(input_dtype) for _ in range(3)]
+    expected = [inp.to(expected_dtype or input_dtype) for inp in inputs]
+
+    assert downcast_calibration_inputs(inputs, dtype) == expected_dtype
+    # the list is cast in place
+    for inp, expected_inp in zip(inputs, expected):
+        assert inp.dtype == (expected_dtype or input_dtype)
+        assert torch.equal(inp, expected_inp)
+
+
+def test_downcast_no_calibration_inputs():
+    assert downcast_calibration_inputs([], torch.bfloat16) is None
+
+
+# only the CPU path is covered here, the pinned memory copies on a separate CUDA
+# stream need a GPU
+@pytest.mark.parametrize("prefetch_batches", [0, 2])
+def test_prefetch_to_device(prefetch_batches):
+    inputs = [torch.randn(1, 4, 8) for _ in range(4)]
+    # data loaders may yield the input first in a tuple
+    data_loader = [inputs[0], (inputs[1], None), inputs[2], (inputs[3],)]
+
+    prefetched = list(prefetch_to_device(data_loader, "cpu", prefetch_batches))
+
+    assert len(prefetched) == len(inputs)
+    for inp, expected in zip(prefetched, inputs):
+        assert inp is expected
+
+
+@pytest.mark.parametrize("nsamples,expected_samples", [(None, 4), (2, 2), (6, 4)])
+def test_catch(nsamples, expected_samples):
+    model = _Decoder()
+    layer = model.layers[0]
+    inputs = [torch.randn(1, 4, 8) for _ in range(4)]
+    data_loader = iter([(inp,) for inp in inputs])
+
+    cache = catch(model, layer, ["attention_mask"], data_loader, nsamples, 2)
+
+    # the original layer is swapped back in once the inputs are caught
+    assert model.layers[0] is layer
+    assert len(cache["inputs"]) == expected_samples
+    assert len(cache["attention_mask"]) == expected_samples
+    for args, expected in zip(cache["inputs"], inputs):
+        assert args[0] is expected
+    # samples past nsamples aren't pulled from the data loader
+    assert len(list(data_loader)) == len(inputs) - expected_samples
@@ -0,0 +1,49 @@
+# Copyright (c) 2021 - present / Neuralmagic, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+
+from sparseml.modifiers.obcq.utils.layer_compressor import LayerCompressor
+
+
+class _DecoderLayer(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.fc = torch.nn.Linear(8, 8)
+
+    def forward(self, hidden_states):
+        return (self.fc(hidden_states),)
+
+
+@pytest.mark.parametrize("calib_dtype", [None, torch.bfloat16])
+def test_post_compress_stores_outputs_in_calib_dtype(calib_dtype):
+    layer = _DecoderLayer()
+    inputs = [torch.randn(1, 4, 8).to(calib_dtype or torch.float32) for _ in range(3)]
+    expected = [layer(inp.float())[0] for inp in inputs]
+
+    compressor = LayerCompressor(None, layer, 0, inputs, {"calib_dtype": calib_dtype})
+    for idx in range(len(inputs)):
+        layer_input = compressor.layer_input(idx)
+        assert layer_input.dtype == torch.float32
+        if calib_dtype is None:
+            # nothing was downcast, so the stored sample is passed through as is
+            assert layer_input is inputs[idx]
+    outputs = compressor.post_compress()["outputs"]
+
+    # the inputs are overwritten in place with the layer outputs
+    assert outputs is inputs
+    for output, expected_output in zip(outputs, expected):
+        assert output.dtype == (calib_dtype or torch.float32)
+        assert torch.equal(output, expected_output.to(output.dtype))
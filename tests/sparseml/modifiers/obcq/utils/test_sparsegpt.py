@@ -0,0 +1,76 @@
+# Copyright (c) 2021 - present / Neuralmagic, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from copy import deepcopy
+
+import pytest
+import torch
+
+from sparseml.modifiers.obcq.utils.sparsegpt import SparseGPT
+
+
+@pytest.fixture(autouse=True)
+def skip_cuda_synchronize(monkeypatch):
+    # fasterprune synchronizes before logging its timing, not available on CPU
+    if not torch.cuda.is_available():
+        monkeypatch.setattr(torch.cuda, "synchronize", lambda: None)
+
+
+def _calibrated_sparsegpt(layer, inputs):
+    gpt = SparseGPT(layer)
+    for inp in inputs:
+        gpt.add_batch(inp, layer(inp))
+    return gpt
+
+
+def test_fasterprune_with_precomputed_hessian_inverse():
+    torch.manual_seed(0)
+    layer = torch.nn.Linear(32, 16)
+    inputs = [torch.randn(4, 32) for _ in range(4)]
+
+    weights = []
+    for precompute in [False, True]:
+        pruned_layer = deepcopy(layer)
+        gpt = _calibrated_sparsegpt(pruned_layer, inputs)
+        if precompute:
+            gpt.compute_hessian_inverse(percdamp=0.01)
+        gpt.fasterprune(0.5, blocksize=8, percdamp=0.01)
+        weights.append(pruned_layer.weight.data)
+
+    assert torch.equal(weights[0], weights[1])
+    assert not torch.equal(weights[0], layer.weight.data)
+
+
+def test_fasterprune_not_positive_definite_raises_error():
+    layer = torch.nn.Linear(8, 4)
+    gpt = SparseGPT(layer)
+    gpt.H = -torch.eye(8)
+    weight = layer.weight.data.clone()
+
+    with pytest.raises(RuntimeError, match="positive-definite"):
+        gpt.fasterprune(0.5)
+    assert torch.equal(layer.weight.data, weight)
+
+
+@pytest.mark.parametrize("prunen,prunem", [(2, 4), (1, 2), (4, 8)])
+def test_fasterprune_n_m_sparsity(prunen, prunem):
+    torch.manual_seed(0)
+    layer = torch.nn.Linear(32, 16)
+    inputs = [torch.randn(4, 32) for _ in range(4)]
+
+    gpt = _calibrated_sparsegpt(layer, inputs)
+    gpt.fasterprune(0.5, prunen=prunen, prunem=prunem, blocksize=16)
+
+    groups = layer.weight.data.reshape(16, -1, prunem)
+    assert torch.all((groups == 0).sum(dim=2) == prunen)
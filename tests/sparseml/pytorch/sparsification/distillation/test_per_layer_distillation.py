@@ -15,6 +15,7 @@
 import os
 import re
 from collections import OrderedDict
+from copy import deepcopy
 from typing import Callable
 
 import pytest
@@ -111,6 +112,47 @@ def test_different_sizes_without_projection_raises_error():
         )
 
 
+@pytest.mark.skipif(
+    os.getenv("NM_ML_SKIP_PYTORCH_TESTS", False),
+    reason="Skipping pytorch tests",
+)
+@pytest.mark.parametrize("cache_dtype", ["int8", "bool", "not_a_dtype"])
+def test_non_floating_cache_dtype_raises_error(cache_dtype):
+    modifier = PerLayerDistillationModifier(cache_dtype=cache_dtype)
+    student = mlp(12, 24, 32)
+    teacher = mlp(12, 24, 32)
+
+    with pytest.raises(ValueError, match="floating point dtype"):
+        modifier.initialize(student, distillation_teacher=teacher)
+
+
+@pytest.mark.skipif(
+    os.getenv("NM_ML_SKIP_PYTORCH_TESTS", False),
+    reason="Skipping pytorch tests",
+)
+def test_no_layers_to_distill():
+    # no Conv2d or Linear layers in either model
+    modifier = PerLayerDistillationModifier()
+    student = nn.Sequential(nn.BatchNorm1d(12), nn.ReLU())
+    teacher = nn.Sequential(nn.BatchNorm1d(12), nn.ReLU())
+    opt = create_optim_sgd(student)
+    modifier.initialize(student, distillation_teacher=teacher)
+
+    x = torch.randn(5, 12)
+    fake_loss = student(x).mean()
+    updated_loss = modifier.loss_update(
+        fake_loss,
+        student,
+        opt,
+        modifier.start_epoch,
+        10,
+        student_inputs=x,
+        student_outputs=fake_loss,
+    )
+
+    assert updated_loss.item() == pytest.approx(fake_loss.item())
+
+
 @pytest.mark.skipif(
     os.getenv("NM_ML_SKIP_PYTORCH_TESTS", False),
     reason="Skipping pytorch tests",
@@ -125,6 +167,7 @@ def test_same_structure_different_layer_sizes():
     teacher = mlp(12, 48, 64, 128)
     opt = create_optim_sgd(student)
     modifier.initialize(student, distillation_teacher=teacher)
+    assert not any(param.requires_grad for param in teacher.parameters())
 
     x = torch.randn(5, 12)
     fake_loss = student(x).mean()
@@ -143,6 +186,37 @@ def test_same_structure_different_layer_sizes():
     assert fake_loss.item() != updated_loss.item()
 
 
+@pytest.mark.skipif(
+    os.getenv("NM_ML_SKIP_PYTORCH_TESTS", False),
+    reason="Skipping pytorch tests",
+)
+def test_teacher_sharing_student_params():
+    modifier = PerLayerDistillationModifier(project_features=False)
+    student = mlp(12, 24, 32)
+    # the teacher reuses the student's first layer
+    teacher = nn.Sequential(student[0], deepcopy(student[1]))
+    opt = create_optim_sgd(student)
+    modifier.initialize(student, distillation_teacher=teacher)
+
+    assert all(param.requires_grad for param in student.parameters())
+    assert not any(param.requires_grad for param in teacher[1].parameters())
+
+    x = torch.randn(5, 12)
+    fake_loss = student(x).mean()
+    updated_loss = modifier.loss_update(
+        fake_loss,
+        student,
+        opt,
+        modifier.start_epoch,
+        10,
+        student_inputs=x,
+        student_outputs=fake_loss,
+    )
+    updated_loss.backward()
+
+    assert all(param.grad is not None for param in student.parameters())
+
+
 @pytest.mark.skipif(
     os.getenv("NM_ML_SKIP_PYTORCH_TESTS", False),
     reason="Skipping pytorch tests",
@@ -175,6 +249,209 @@ def test_different_structure():
     assert fake_loss.item() != updated_loss.item()
 
 
+@pytest.mark.skipif(
+    os.getenv("NM_ML_SKIP_PYTORCH_TESTS", False),
+    reason="Skipping pytorch tests",
+)
+def test_grouped_conv_projections_match_per_layer():
+    torch.manual_seed(0)
+    modifier = PerLayerDistillationModifier()
+    student = nn.Sequential(
+        *[nn.Conv2d(3 if i == 0 else 8, 8, 3, padding=1) for i in range(3)]
+    )
+    teacher = nn.Sequential(
+        *[nn.Conv2d(3 if i == 0 else 16, 16, 3, padding=1) for i in range(3)]
+    )
+    opt = create_optim_sgd(student)
+    modifier.initialize(student, distillation_teacher=teacher)
+
+    student_outputs, teacher_outputs = {}, {}
+    for idx in range(3):
+        student[idx].register_forward_hook(
+            lambda _, __, out, name=str(idx): student_outputs.update({name: out})
+        )
+        teacher[idx].register_forward_hook(
+            lambda _, __, out, name=str(idx): teacher_outputs.update({name: out})
+        )
+
+    # all three projections map 8 -> 16 channels on 8x8 activations, so they run
+    # grouped. The second step covers the grouped projections when streaming
+    for _ in range(2):
+        x = torch.randn(2, 3, 8, 8)
+        fake_loss = student(x).mean()
+        updated_loss = modifier.loss_update(
+            fake_loss,
+            student,
+            opt,
+            modifier.start_epoch,
+            10,
+            student_inputs=x,
+            student_outputs=fake_loss,
+        )
+
+    # reference loss with one projection per layer
+    projections = modifier.state_dict()[DISTILL_PARAM_GROUP_KEY]
+    distillation_loss = 0.0
+    for name, projection in projections.items():
+        projected = torch.nn.functional.conv2d(
+            student_outputs[name], projection["weight"]
+        )
+        teacher_output = teacher_outputs[name]
+        distillation_loss += (projected - teacher_output).square().mean() / (
+            teacher_output.square().mean() + modifier.epsilon
+        )
+    expected_loss = fake_loss + modifier.gain * distillation_loss
+
+    assert updated_loss.item() == pytest.approx(expected_loss.item())
+    params = list(student.parameters())
+    grads = torch.autograd.grad(updated_loss, params, retain_graph=True)
+    expected_grads = torch.autograd.grad(expected_loss, params)
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad, atol=1e-6)
+
+
+class _TwoDeviceConvs(Module):
+    def __init__(self, channels: int, devices):
+        super().__init__()
+        self._devices = devices
+        self.conv0 = nn.Conv2d(3, channels, 1).to(devices[0])
+        self.conv1 = nn.Conv2d(channels, channels, 1).to(devices[1])
+
+    def forward(self, x):
+        x = self.conv0(x.to(self._devices[0]))
+        return self.conv1(x.to(self._devices[1]))
+
+
+@pytest.mark.skipif(
+    os.getenv("NM_ML_SKIP_PYTORCH_TESTS", False),
+    reason="Skipping pytorch tests",
+)
+@pytest.mark.parametrize(
+    "devices",
+    [
+        ("cpu", "cpu"),
+        pytest.param(
+            ("cuda:0", "cuda:1"),
+            marks=pytest.mark.skipif(
+                torch.cuda.device_count() < 2, reason="requires two cuda devices"
+            ),
+        ),
+    ],
+)
+def test_projections_across_devices(devices):
+    # both projections map 8 -> 16 channels, but can only be grouped on one device
+    student = _TwoDeviceConvs(8, devices)
+    teacher = _TwoDeviceConvs(16, devices)
+    modifier = PerLayerDistillationModifier()
+    modifier.initialize(student, distillation_teacher=teacher)
+    opt = create_optim_sgd(student)
+
+    for _ in range(2):
+        x = torch.randn(2, 3, 4, 4, device=devices[0])
+        fake_loss = student(x).mean()
+        updated_loss = modifier.loss_update(
+            fake_loss,
+            student,
+            opt,
+            modifier.start_epoch,
+            10,
+            student_inputs=x,
+            student_outputs=fake_loss,
+        )
+        updated_loss.backward()
+
+    assert torch.isfinite(updated_loss)
+    assert all(torch.isfinite(p.grad).all() for p in student.parameters())
+
+
+@pytest.mark.skipif(
+    os.getenv("NM_ML_SKIP_PYTORCH_TESTS", False),
+    reason="Skipping pytorch tests",
+)
+@pytest.mark.parametrize("project_features", [True, False])
+def test_streaming_loss_matches_cached_loss(project_features):
+    torch.manual_seed(0)
+    student = mlp(12, 24, 32)
+    teacher = mlp(12, 24, 32)
+    inputs = [torch.randn(5, 12) for _ in range(2)]
+
+    losses, grads = [], []
+    for streaming_loss in [False, True]:
+        torch.manual_seed(1)
+        model = deepcopy(student)
+        modifier = PerLayerDistillationModifier(
+            project_features=project_features, streaming_loss=streaming_loss
+        )
+        modifier.initialize(model, distillation_teacher=deepcopy(teacher))
+        opt = create_optim_sgd(model)
+
+        # the first step caches teacher outputs to create the projections
+        for x in inputs:
+            fake_loss = model(x).mean()
+            updated_loss = modifier.loss_update(
+                fake_loss,
+                model,
+                opt,
+                modifier.start_epoch,
+                10,
+                student_inputs=x,
+                student_outputs=fake_loss,
+            )
+        model.zero_grad()
+        updated_loss.backward()
+        losses.append(updated_loss.item())
+        grads.append([p.grad.clone() for p in model.parameters()])
+
+    assert losses[0] == pytest.approx(losses[1])
+    for cached_grad, streamed_grad in zip(*grads):
+        assert torch.allclose(cached_grad, streamed_grad)
+
+
+@pytest.mark.skipif(
+    os.getenv("NM_ML_SKIP_PYTORCH_TESTS", False),
+    reason="Skipping pytorch tests",
+)
+def test_streaming_loss_with_teacher_run_between_steps():
+    torch.manual_seed(0)
+    student = mlp(12, 24, 32)
+    teacher = mlp(12, 24, 32)
+    inputs = [torch.randn(5, 12) for _ in range(3)]
+
+    losses, grads = [], []
+    for streaming_loss in [False, True]:
+        torch.manual_seed(1)
+        model = deepcopy(student)
+        distill_teacher = deepcopy(teacher)
+        modifier = PerLayerDistillationModifier(streaming_loss=streaming_loss)
+        modifier.initialize(model, distillation_teacher=distill_teacher)
+        opt = create_optim_sgd(model)
+
+        for x in inputs:
+            fake_loss = model(x).mean()
+            updated_loss = modifier.loss_update(
+                fake_loss,
+                model,
+                opt,
+                modifier.start_epoch,
+                10,
+                student_inputs=x,
+                student_outputs=fake_loss,
+            )
+            model.zero_grad()
+            updated_loss.backward()
+
+            # e.g. evaluating the teacher, must not reuse this step's student graph
+            with torch.no_grad():
+                distill_teacher(x)
+
+        losses.append(updated_loss.item())
+        grads.append([p.grad.clone() for p in model.parameters()])
+
+    assert losses[0] == pytest.approx(losses[1])
+    for cached_grad, streamed_grad in zip(*grads):
+        assert torch.allclose(cached_grad, streamed_grad)
+
+
 @pytest.mark.skipif(
     os.getenv("NM_ML_SKIP_PYTORCH_TESTS", False),
     reason="Skipping pytorch tests",
@@ -304,6 +581,8 @@ def test_distillation_modifier_yaml():
         teacher_layer_names=["d", "e", "f"],
         project_features=False,
         epsilon=3.0,
+        cache_dtype="bfloat16",
+        streaming_loss=False,
     )
     yaml_str = f"""
         !PerLayerDistillationModifier
@@ -316,6 +595,8 @@ def test_distillation_modifier_yaml():
             teacher_layer_names: {truth.teacher_layer_names}
             project_features: {truth.project_features}
             epsilon: {truth.epsilon}
+            cache_dtype: {truth.cache_dtype}
+            streaming_loss: {truth.streaming_loss}
         """
     from_yaml = PerLayerDistillationModifier.load_obj(yaml_str)
     twice_from_yaml = PerLayerDistillationModifier.load_obj(str(from_yaml))
@@ -331,6 +612,8 @@ def test_distillation_modifier_yaml():
         "teacher_layer_names",
         "project_features",
         "epsilon",
+        "cache_dtype",
+        "streaming_loss",
     ]:
         assert (
             getattr(truth, attr_name)
@@ -31,6 +31,7 @@ from sparseml.pytorch.utils import (
     MEMORY_BOUNDED,
     default_device,
     early_stop_data_loader,
+    get_floating_point_dtype,
     get_optim_learning_rate,
     infinite_data_loader,
     mask_difference,
@@ -911,3 +912,30 @@ def test_memory_aware_threshold(tensor, idx):
 
     if prior_state is not None:
         os.environ[MEMORY_BOUNDED] = prior_state
+
+
+@pytest.mark.skipif(
+    os.getenv("NM_ML_SKIP_PYTORCH_TESTS", False),
+    reason="Skipping pytorch tests",
+)
+@pytest.mark.parametrize(
+    "dtype_name,expected_dtype",
+    [
+        (None, None),
+        ("float32", torch.float32),
+        ("float16", torch.float16),
+        ("bfloat16", torch.bfloat16),
+    ],
+)
+def test_get_floating_point_dtype(dtype_name, expected_dtype):
+    assert get_floating_point_dtype(dtype_name) == expected_dtype
+
+
+@pytest.mark.skipif(
+    os.getenv("NM_ML_SKIP_PYTORCH_TESTS", False),
+    reason="Skipping pytorch tests",
+)
+@pytest.mark.parametrize("dtype_name", ["int8", "bool", "nn", "not_a_dtype"])
+def test_get_floating_point_dtype_raises_error(dtype_name):
+    with pytest.raises(ValueError):
+        get_floating_point_dtype(dtype_name)